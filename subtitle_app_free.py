@@ -1,8 +1,9 @@
 import streamlit as st
-import whisper
+import ctranslate2
+from faster_whisper import WhisperModel, decode_audio
 import os
+import numpy as np
 import pandas as pd
-from datetime import timedelta
 from moviepy import VideoFileClip
 import streamlit.components.v1 as components
 
@@ -14,26 +15,57 @@ os.environ["PATH"] = os.getcwd() + os.pathsep + os.environ["PATH"]
 
 def format_timestamp(seconds):
     """秒数をSRT形式のタイムスタンプ (HH:MM:SS,mmm) に変換"""
-    td = timedelta(seconds=seconds)
-    total_seconds = int(td.total_seconds())
-    hours = total_seconds // 3600
-    minutes = (total_seconds % 3600) // 60
-    secs = total_seconds % 60
-    millis = int(td.microseconds / 1000)
+    # マイクロ秒に丸めてからミリ秒を切り捨てる (timedeltaと同じ結果)
+    millis = round(seconds * 1_000_000) // 1000
+    hours, millis = divmod(millis, 3_600_000)
+    minutes, millis = divmod(millis, 60_000)
+    secs, millis = divmod(millis, 1000)
     return f"{hours:02}:{minutes:02}:{secs:02},{millis:03}"
 
+def format_timestamps(seconds):
+    """秒数の配列をまとめてSRT形式のタイムスタンプのリストに変換"""
+    seconds = np.asarray(seconds, dtype=np.float64)
+    if seconds.size == 0:
+        return []
+    millis = np.round(seconds * 1_000_000).astype(np.int64) // 1000
+    # 固定幅 (12文字) に収まらない負の値・100時間以上は1件ずつ変換
+    if millis.min() < 0 or millis.max() >= 100 * 3_600_000:
+        return [format_timestamp(s) for s in seconds]
+
+    hours, millis = np.divmod(millis, 3_600_000)
+    minutes, millis = np.divmod(millis, 60_000)
+    secs, millis = np.divmod(millis, 1000)
+
+    # "HH:MM:SS,mmm" のASCIIバイト列を全行分まとめて書き込む
+    buf = np.empty((seconds.size, 12), dtype=np.uint8)
+    buf[:, [2, 5]] = ord(":")
+    buf[:, 8] = ord(",")
+    buf[:, [0, 1, 3, 4, 6, 7, 9, 10, 11]] = np.stack([
+        hours // 10, hours % 10,
+        minutes // 10, minutes % 10,
+        secs // 10, secs % 10,
+        millis // 100, millis // 10 % 10, millis % 10,
+    ], axis=1) + ord("0")
+    text = buf.tobytes().decode("ascii")
+    return [text[i:i + 12] for i in range(0, len(text), 12)]
+
+@st.cache_data(max_entries=4)
 def create_srt_content(df):
     """データフレームからSRT形式の文字列を生成"""
+    # 開始・終了が未入力の行 (data_editorで追加した直後など) は出力しない
+    df = df.dropna(subset=['start', 'end'])
+    starts = format_timestamps(df['start'].to_numpy())
+    ends = format_timestamps(df['end'].to_numpy())
+    texts = df['text'].fillna("").to_list()
+
     # 無料版用の透かし広告を先頭に強制追加
-    srt_content = "1\n00:00:00,000 --> 00:00:05,000\n[Created by AI Subtitle Free]\n\n"
-    
-    for idx, row in df.iterrows():
-        start = format_timestamp(row['start'])
-        end = format_timestamp(row['end'])
-        text = row['text']
-        # 連番を+2する（1番目は透かし用）
-        srt_content += f"{idx + 2}\n{start} --> {end}\n{text}\n\n"
-    return srt_content
+    parts = ["1\n00:00:00,000 --> 00:00:05,000\n[Created by AI Subtitle Free]"]
+    # 連番は2から開始する（1番目は透かし用）
+    parts.extend(
+        f"{i}\n{start} --> {end}\n{text}"
+        for i, (start, end, text) in enumerate(zip(starts, ends, texts), 2)
+    )
+    return "\n\n".join(parts) + "\n\n"
 
 def save_uploaded_file(uploaded_file):
     """アップロードされたファイルを一時ファイルとして保存"""
@@ -60,9 +92,20 @@ def get_video_duration(file_path):
         return 0
 
 # --- モデル読み込み (キャッシュ化) ---
-@st.cache_resource
+# サイズ切替時に古いモデルを破棄し、常駐するモデルを1つに抑える
+@st.cache_resource(max_entries=1)
 def load_model(model_size):
-    return whisper.load_model(model_size)
+    # CTranslate2バックエンド: GPUならFP16、CPUならINT8量子化で推論
+    if ctranslate2.get_cuda_device_count() > 0:
+        return WhisperModel(model_size, device="cuda", compute_type="float16")
+    return WhisperModel(model_size, device="cpu", compute_type="int8")
+
+# --- 音声デコード (キャッシュ化) ---
+# file_id をキーに含め、同名ファイルの再アップロードでも取り違えないようにする
+@st.cache_data(show_spinner=False, max_entries=2)
+def load_audio(file_path, file_id):
+    """動画/音声ファイルを16kHzモノラルの波形 (NumPy配列) にデコード"""
+    return decode_audio(file_path)
 
 # --- アプリケーション本体 ---
 
@@ -103,6 +146,17 @@ with st.sidebar:
     language = st.selectbox("言語", ["Japanese", "English"], index=0)
     lang_code = "ja" if language == "Japanese" else "en"
 
+    fast_decode = st.checkbox(
+        "高速デコード",
+        value=True,
+        help="ビーム探索を行わず貪欲法でデコードします。OFFにすると精度は上がりますが遅くなります。"
+    )
+    use_prev_text = st.checkbox(
+        "前の文脈を参照",
+        value=False,
+        help="直前の文字起こし結果を次の区間の推論に利用します。ONにすると遅くなり、繰り返しが起きやすくなります。"
+    )
+
     st.divider()
     st.caption("🔒 Pro版機能")
     st.markdown("""
@@ -223,11 +277,13 @@ if uploaded_file is not None:
     
     if temp_file_path:
         # 動画プレビュー
-        # 動画プレビュー
-        if any(ext in uploaded_file.name for ext in ["mp4", "mov"]):
-            st.video(temp_file_path)
-        else:
-            st.audio(temp_file_path)
+        # OFFにすると再実行のたびに大きなファイルを再送信しない
+        if st.checkbox("プレビューを表示", value=True, key="show_preview"):
+            # ファイル名の部分一致ではなくMIMEタイプで判定 (例: "movie.mp3" を動画扱いしない)
+            if uploaded_file.type.startswith("video/"):
+                st.video(temp_file_path)
+            else:
+                st.audio(temp_file_path)
 
         st.markdown("### 文字起こし開始")
         
@@ -241,45 +297,56 @@ if uploaded_file is not None:
                 with st.spinner(f"{model_size}モデルで解析中..."):
                     try:
                         model = load_model(model_size)
-                        result = model.transcribe(temp_file_path, language=lang_code)
+                        audio = load_audio(temp_file_path, uploaded_file.file_id)
+                        segments, info = model.transcribe(
+                            audio,
+                            language=lang_code,
+                            vad_filter=True,
+                            beam_size=1 if fast_decode else 5,
+                            condition_on_previous_text=use_prev_text,
+                        )
                         
-                        st.session_state['free_segments'] = result['segments']
+                        # ジェネレータを消費し、編集用のデータフレームを文字起こし直後に1回だけ作る
+                        # (実際のデコードはここで走るため、失敗時は以前の結果と編集内容を残す)
+                        edit_df = pd.DataFrame(
+                            [(seg.start, seg.end, seg.text) for seg in segments],
+                            columns=['start', 'end', 'text'],
+                        ).astype({'start': float, 'end': float})
+                        # 前回の編集内容 (差分) が新しい結果に適用されないよう破棄
+                        st.session_state.pop('free_editor', None)
+                        st.session_state['free_edit_df'] = edit_df
                         st.success("文字起こし完了！")
                     except Exception as e:
                         st.error(f"エラーが発生しました: {e}")
 
 # 結果表示と編集エリア
-if 'free_segments' in st.session_state:
+if 'free_edit_df' in st.session_state:
     st.divider()
     st.header("📝 字幕データの確認")
-    
-    df = pd.DataFrame(st.session_state['free_segments'])
-    if 'text' not in df.columns:
-         st.error("データが不正です。")
-    else:
-        # Free版は簡易編集のみ提供 (DataEditorは使えるようにしておく)
-        edit_df = df[['start', 'end', 'text']].copy()
-        
-        edited_df = st.data_editor(
-            edit_df,
-            column_config={
-                "start": st.column_config.NumberColumn("開始", format="%.2f"),
-                "end": st.column_config.NumberColumn("終了", format="%.2f"),
-                "text": st.column_config.TextColumn("内容", width="large"),
-            },
-            num_rows="dynamic",
-            use_container_width=True
-        )
 
-        st.subheader("📥 ダウンロード")
-        srt_content = create_srt_content(edited_df)
-        
-        st.download_button(
-            label="SRTファイルを保存",
-            data=srt_content,
-            file_name="subtitles_free.srt",
-            mime="text/plain",
-            use_container_width=True
-        )
-        
-        st.info("💡 ヒント: ASS形式での出力や詳細なスタイル設定を行いたい場合は Pro版 をご利用ください。")
+    # Free版は簡易編集のみ提供 (DataEditorは使えるようにしておく)
+    # 元データは書き換えず、編集内容は key のウィジェット状態として保持する
+    edited_df = st.data_editor(
+        st.session_state['free_edit_df'],
+        key="free_editor",
+        column_config={
+            "start": st.column_config.NumberColumn("開始", format="%.2f", min_value=0.0),
+            "end": st.column_config.NumberColumn("終了", format="%.2f", min_value=0.0),
+            "text": st.column_config.TextColumn("内容", width="large"),
+        },
+        num_rows="dynamic",
+        use_container_width=True
+    )
+
+    st.subheader("📥 ダウンロード")
+    srt_content = create_srt_content(edited_df)
+    
+    st.download_button(
+        label="SRTファイルを保存",
+        data=srt_content,
+        file_name="subtitles_free.srt",
+        mime="text/plain",
+        use_container_width=True
+    )
+    
+    st.info("💡 ヒント: ASS形式での出力や詳細なスタイル設定を行いたい場合は Pro版 をご利用ください。")